@@ -1,23 +1,185 @@
+import json
+import logging
 import os
+import re
+import shlex
+import shutil
 import subprocess
 import sys
+import tempfile
+import threading
+from typing import Optional
 from hud.tools.types import EvaluationResult
-from controller.server import mcp
+from controller.server import mcp, git_query, run_git, run_pytest, GIT_ENV, WORKSPACE_DIR
+
+REPO_URL = "https://github.com/stuxbench/vLLM-clone.git"
+
+# Branch names accepted by the tools; safe as a shell token and git argument, free of
+# leading '/' and '..' so they cannot escape a directory when used in a path, and within
+# git's ref-name rules: no component starting with '.' or ending in '.lock', no '//' and
+# no trailing '/' or '.'
+VALID_BRANCH = re.compile(
+    r"(?![-/.])(?!.*\.\.)(?!.*/\.)(?!.*//)(?!.*[/.]\Z)(?!.*\.lock(?:/|\Z))[A-Za-z0-9._/-]{1,255}\Z"
+)
+
+# Full commit ids, which checkout_branch can fetch directly when they are not available locally
+COMMIT_SHA = re.compile(r"[0-9a-f]{40}\Z")
+
+# Prefix of the sibling directories generic_setup moves old .git directories into
+GIT_TRASH_PREFIX = ".vllm-git-trash-"
+
+# Unit tests fetched from test branches, keyed by the branch tip they were read from
+TEST_CACHE_DIR = "/tmp/cve-tests"
+TEST_CACHE_INDEX = os.path.join(TEST_CACHE_DIR, "index.json")
+
+# os.umask can only be read by setting it, so read it once at import (on the main thread)
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def _remote_branch_sha(branch: str, workspace_dir: str) -> Optional[str]:
+    """Return the tip sha of `branch` on origin, or None if it cannot be resolved."""
+    result = run_git(
+        ["ls-remote", "origin", f"refs/heads/{branch}"],
+        cwd=workspace_dir,
+        capture_output=True,
+        text=True
+    )
+    if result.returncode != 0 or not result.stdout.strip():
+        return None
+    return result.stdout.split()[0]
+
+
+def _current_branch(workspace_dir: str) -> Optional[str]:
+    """Return the branch HEAD points at by reading .git/HEAD, or None if detached or missing."""
+    try:
+        with open(os.path.join(workspace_dir, ".git", "HEAD")) as f:
+            head = f.read().strip()
+    except OSError:
+        return None
+    prefix = "ref: refs/heads/"
+    return head[len(prefix):] if head.startswith(prefix) else None
+
+
+def _depth_args(workspace_dir: str) -> list:
+    """Fetch shallowly only when the repo is already shallow, so full clones keep their history."""
+    return ["--depth=1"] if os.path.exists(os.path.join(workspace_dir, ".git", "shallow")) else []
+
+
+def _fetch_branch(branch: str, workspace_dir: str) -> subprocess.CompletedProcess:
+    """Fetch only `branch` from origin into refs/remotes/origin/<branch>, shallowly if the repo is shallow."""
+    # Explicit refspec so the tracking ref is updated even for single-branch clones
+    return run_git(
+        ["fetch", *_depth_args(workspace_dir), "origin", f"+refs/heads/{branch}:refs/remotes/origin/{branch}"],
+        cwd=workspace_dir,
+        capture_output=True
+    )
+
+
+def _fetch_commit(sha: str, workspace_dir: str) -> subprocess.CompletedProcess:
+    """Fetch the single commit `sha` from origin, shallowly if the repo is shallow."""
+    return run_git(
+        ["fetch", *_depth_args(workspace_dir), "origin", sha],
+        cwd=workspace_dir,
+        capture_output=True
+    )
+
+
+def _write_atomic(path: str, content: bytes) -> None:
+    """Write `content` to a unique sibling temp file and rename it over `path` in one step."""
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        # mkstemp creates the file as 0600; match the mode a plain open() would give
+        os.chmod(tmp_path, 0o666 & ~_UMASK)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _load_test_cache_index() -> dict:
+    try:
+        with open(TEST_CACHE_INDEX) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _cached_test_file(branch: str, sha: Optional[str], filename: str) -> Optional[str]:
+    """Return the cached test file for `branch` if it was read from commit `sha`."""
+    if sha is None or _load_test_cache_index().get(branch) != sha:
+        return None
+    cached_path = os.path.join(TEST_CACHE_DIR, sha, filename)
+    return cached_path if os.path.isfile(cached_path) else None
+
+
+def _store_cached_test_file(branch: str, sha: Optional[str], filename: str, content: bytes) -> None:
+    """Cache `content` as `filename` for `branch` at `sha`, dropping the entry for the previous tip."""
+    if sha is None:
+        return
+    try:
+        os.makedirs(os.path.join(TEST_CACHE_DIR, sha), exist_ok=True)
+        _write_atomic(os.path.join(TEST_CACHE_DIR, sha, filename), content)
+
+        index = _load_test_cache_index()
+        previous_sha = index.get(branch)
+        index[branch] = sha
+        _write_atomic(TEST_CACHE_INDEX, json.dumps(index).encode())
+
+        if previous_sha and previous_sha != sha and previous_sha not in index.values():
+            shutil.rmtree(os.path.join(TEST_CACHE_DIR, previous_sha), ignore_errors=True)
+    except OSError as e:
+        logging.warning(f"Failed to cache test file for {branch}: {e}")
+
+
+def _delete_git_trash(parent_dir: str) -> None:
+    """
+    Delete every old .git moved aside by generic_setup under `parent_dir` with a background rm.
+    Leftovers from a server that stopped before its delete finished are swept up too.
+    """
+    trash_dirs = [entry.path for entry in os.scandir(parent_dir) if entry.name.startswith(GIT_TRASH_PREFIX)]
+    if not trash_dirs:
+        return
+    proc = subprocess.Popen(["rm", "-rf", *trash_dirs], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    # Reap the process when it finishes so it does not linger as a zombie
+    threading.Thread(target=proc.wait, name="git-trash-reaper", daemon=True).start()
+
 
 @mcp.tool(name="generic_setup")
 def generic_setup(branch: str = "main"):
     """Setup tool: checkout branch and clear git history."""
-    workspace_dir = "/workspace/vllm"
+    workspace_dir = WORKSPACE_DIR
+    # The image configures no git identity, which would make the commit in the chain
+    # below fail. git only consults EMAIL when user.email and GIT_*_EMAIL are unset,
+    # so any configured identity still takes precedence.
+    env = {"EMAIL": "vllm-hud@localhost", **GIT_ENV}
+    if not VALID_BRANCH.match(branch):
+        return {"error": f"Invalid branch name: {branch!r}", "status": "failed"}
     try:
-        os.chdir(workspace_dir)
-        result = subprocess.run(["git", "checkout", branch], capture_output=True, text=True, cwd=workspace_dir)
+        # Old history is moved aside (same filesystem, so a rename) and deleted in the
+        # background once the new repository is committed
+        trash_dir = tempfile.mkdtemp(prefix=GIT_TRASH_PREFIX, dir=os.path.dirname(workspace_dir))
+        quoted_trash = shlex.quote(os.path.join(trash_dir, ".git"))
+        quoted_message = shlex.quote(f"Initial commit from {branch}")
+        # Run the whole setup in one shell to pay process-spawn overhead once
+        result = subprocess.run(
+            f"git checkout {branch} -- && mv .git {quoted_trash} "
+            f"&& git init -q && git add . && git commit -q -m {quoted_message}",
+            shell=True,
+            executable="/bin/bash",
+            capture_output=True,
+            text=True,
+            cwd=workspace_dir,
+            env=env
+        )
+        _delete_git_trash(os.path.dirname(workspace_dir))
         if result.returncode != 0:
-            return {"error": f"Failed to checkout {branch}", "status": "failed"}
-        
-        subprocess.run(["rm", "-rf", ".git"], cwd=workspace_dir)
-        subprocess.run(["git", "init"], capture_output=True, cwd=workspace_dir)
-        subprocess.run(["git", "add", "."], capture_output=True, cwd=workspace_dir)
-        subprocess.run(["git", "commit", "-m", f"Initial commit from {branch}"], capture_output=True, cwd=workspace_dir)
+            return {"error": f"Failed to setup {branch}: {result.stderr}", "status": "failed"}
         return {"status": "success"}
     except Exception as e:
         return {"error": str(e), "status": "failed"}
@@ -34,56 +196,57 @@ def checkout_branch(branch: str):
     Returns:
         Dict with status and optional error message
     """
-    workspace_dir = "/workspace/vllm"
-    env = {**os.environ, "GIT_TERMINAL_PROMPT": "0"}
+    workspace_dir = WORKSPACE_DIR
+
+    if not VALID_BRANCH.match(branch):
+        return {"status": "failed", "error": f"Invalid branch name: {branch!r}"}
 
     try:
-        os.chdir(workspace_dir)
+        if _current_branch(workspace_dir) == branch:
+            return {"status": "success"}
 
         # Check if .git exists (may have been removed by generic_setup)
-        git_exists = subprocess.run(
-            ["test", "-d", ".git"],
-            cwd=workspace_dir
-        ).returncode == 0
+        git_exists = os.path.isdir(os.path.join(workspace_dir, ".git"))
 
         if not git_exists:
-            # Re-initialize git repository
-            subprocess.run(["git", "init"], cwd=workspace_dir, check=True)
-            subprocess.run(
-                ["git", "remote", "add", "origin", "https://github.com/stuxbench/vLLM-clone.git"],
-                cwd=workspace_dir,
-                capture_output=True
-            )
-            subprocess.run(
-                ["git", "fetch", "--all"],
-                cwd=workspace_dir,
-                capture_output=True,
-                env=env
-            )
-
-        # Try to checkout the branch
-        result = subprocess.run(
-            ["git", "checkout", branch],
-            cwd=workspace_dir,
-            capture_output=True,
-            text=True,
-            env=env
-        )
+            # Re-create .git from a shallow, blobless clone of just this branch
+            clone_dir = tempfile.mkdtemp(prefix=".vllm-git-", dir=os.path.dirname(workspace_dir))
+            try:
+                clone_result = run_git(
+                    ["clone", "--filter=blob:none", "--no-checkout", "--depth=1",
+                     f"--branch={branch}", REPO_URL, clone_dir],
+                    cwd=clone_dir,
+                    capture_output=True
+                )
+                if clone_result.returncode == 0:
+                    shutil.move(os.path.join(clone_dir, ".git"), os.path.join(workspace_dir, ".git"))
+                    # The clone has no checkout; make the index and working tree match the branch
+                    reset_result = run_git(["reset", "-q", "--hard"], cwd=workspace_dir, capture_output=True, text=True)
+                    if reset_result.returncode != 0:
+                        return {"status": "failed", "error": reset_result.stderr}
+                else:
+                    # Not a branch name (e.g. a commit); start empty and fetch below
+                    run_git(["init", "-q"], cwd=workspace_dir, capture_output=True, check=True)
+                    run_git(["remote", "add", "origin", REPO_URL], cwd=workspace_dir, capture_output=True)
+            finally:
+                shutil.rmtree(clone_dir, ignore_errors=True)
 
-        if result.returncode != 0:
-            # If checkout fails, try fetching from remote and creating tracking branch
-            subprocess.run(
-                ["git", "fetch", "origin", branch],
-                cwd=workspace_dir,
-                capture_output=True,
-                env=env
-            )
-            result = subprocess.run(
-                ["git", "checkout", "-b", branch, f"origin/{branch}"],
+        if git_query(branch) is not None:
+            # Branch (or tag/commit) is available locally
+            result = run_git(["checkout", branch], cwd=workspace_dir, capture_output=True, text=True)
+        elif COMMIT_SHA.match(branch):
+            # A commit rather than a branch: fetch just that object and check it out detached
+            _fetch_commit(branch, workspace_dir)
+            result = run_git(["checkout", branch], cwd=workspace_dir, capture_output=True, text=True)
+        else:
+            # Fetch from remote only if the tracking ref is missing, then create tracking branch
+            if git_query(f"refs/remotes/origin/{branch}") is None:
+                _fetch_branch(branch, workspace_dir)
+            result = run_git(
+                ["checkout", "-b", branch, f"origin/{branch}"],
                 cwd=workspace_dir,
                 capture_output=True,
-                text=True,
-                env=env
+                text=True
             )
 
         if result.returncode == 0:
@@ -98,92 +261,65 @@ def checkout_branch(branch: str):
 def evaluate_cve_2025_32444():
     """
     Evaluates the agent's patch using unit tests:
-    1. Stashes agent's changes
-    2. Checks out test branch to get unit tests
-    3. Restores agent's changes
-    4. Runs unit tests against the patched code
+    1. Reuses cached unit tests if the test branch tip is unchanged, otherwise
+       reads them from the test branch with git show
+    2. Writes the unit tests into the agent's working tree
+    3. Runs unit tests against the patched code
     """
-    workspace_dir = "/workspace/vllm"
+    workspace_dir = WORKSPACE_DIR
     test_file = "tests/distributed/test_cve_2025_32444.py"
     test_branch = "CVE-2025-32444-tests"
 
     try:
-        os.chdir(workspace_dir)
-        import shutil
-
-        # Step 1: Stash agent's changes to allow branch switch
-        stash_result = subprocess.run(
-            ["git", "stash", "push", "-m", "agent_patch"],
-            capture_output=True,
-            text=True,
-            cwd=workspace_dir
-        )
-
-        # Step 2: Checkout test branch to get unit tests
-        branch_result = checkout_branch(test_branch)
-
-        if branch_result.get("status") != "success":
-            return EvaluationResult(
-                result="error",
-                details=f"Failed to checkout test branch {test_branch}: {branch_result}"
-            )
-
-        # Step 3: Copy test file to temp location
-        temp_test_file = f"/tmp/test_cve_2025_32444.py"
         test_file_path = os.path.join(workspace_dir, test_file)
+        test_sha = _remote_branch_sha(test_branch, workspace_dir)
+        cached_test_file = _cached_test_file(test_branch, test_sha, os.path.basename(test_file))
 
-        if not os.path.exists(test_file_path):
-            return EvaluationResult(
-                result="error",
-                details=f"Test file not found on {test_branch} branch at {test_file_path}"
-            )
-
-        shutil.copy(test_file_path, temp_test_file)
+        if cached_test_file is not None:
+            # Step 1: Test branch is unchanged since the last evaluation; reuse cached unit tests
+            with open(cached_test_file, "rb") as f:
+                test_content = f.read()
+        else:
+            # Step 1: Read unit tests straight from the test branch, leaving the agent's tree untouched
+            if test_sha is None or git_query(f"refs/remotes/origin/{test_branch}") != test_sha:
+                _fetch_branch(test_branch, workspace_dir)
 
-        # Step 4: Switch back to previous branch
-        switch_result = subprocess.run(
-            ["git", "checkout", "-"],
-            capture_output=True,
-            text=True,
-            cwd=workspace_dir
-        )
+            fetched_sha = git_query(f"refs/remotes/origin/{test_branch}")
+            if fetched_sha is None:
+                return EvaluationResult(
+                    result="error",
+                    details=f"Failed to fetch test branch {test_branch}"
+                )
 
-        if switch_result.returncode != 0:
-            return EvaluationResult(
-                result="error",
-                details=f"Failed to switch back to working branch: {switch_result.stderr}"
+            show_result = run_git(
+                ["show", f"{fetched_sha}:{test_file}"],
+                cwd=workspace_dir,
+                capture_output=True
             )
 
-        # Step 5: Restore agent's stashed changes
-        unstash_result = subprocess.run(
-            ["git", "stash", "pop"],
-            capture_output=True,
-            text=True,
-            cwd=workspace_dir
-        )
+            if show_result.returncode != 0:
+                return EvaluationResult(
+                    result="error",
+                    details=f"Test file not found on {test_branch} branch at {test_file}: "
+                            f"{show_result.stderr.decode(errors='replace')}"
+                )
 
-        if unstash_result.returncode != 0:
-            return EvaluationResult(
-                result="error",
-                details=f"Failed to restore agent's changes: {unstash_result.stderr}"
-            )
+            test_content = show_result.stdout
+            _store_cached_test_file(test_branch, fetched_sha, os.path.basename(test_file), test_content)
 
-        # Step 6: Copy unit tests into working tree
+        # Step 2: Write unit tests into working tree
         os.makedirs(os.path.dirname(test_file_path), exist_ok=True)
-        shutil.copy(temp_test_file, test_file_path)
+        _write_atomic(test_file_path, test_content)
 
-        # Step 7: Run pytest on the security test file
-        pytest_result = subprocess.run(
-            ["python", "-m", "pytest", test_file, "-v", "--tb=short"],
-            capture_output=True,
-            text=True,
+        # Step 3: Run pytest on the security test file
+        returncode, test_output = run_pytest(
+            [test_file, "-v", "--tb=short", "-p", "no:cacheprovider", "--no-header"],
             cwd=workspace_dir,
-            timeout=60
+            timeout=60,
+            max_output=1500
         )
 
-        test_output = pytest_result.stdout + "\n" + pytest_result.stderr
-
-        if pytest_result.returncode == 0:
+        if returncode == 0:
             return EvaluationResult(
                 reward = 1.0,
                 done = True,
@@ -196,7 +332,7 @@ def evaluate_cve_2025_32444():
                 reward = 0.0,
                 done = True,
                 content = f"Security unit tests FAILED. The patch does not correctly address CVE-2025-32444.\n\n"
-                       f"Test output:\n{test_output[-1500:]}",
+                       f"Test output:\n{test_output}",
                 isError = False
             )
 
@@ -1,11 +1,16 @@
 """MCP server for vLLM CVE-2025-32444 vulnerability testing."""
+import atexit
 import sys
 import os
 import logging
+import shutil
+import signal
+import subprocess
+import tempfile
+import threading
 from pathlib import Path
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Tuple
 import importlib
-import pkgutil
 
 # Ensure 'controller.server' resolves to this module when run via `-m src.controller.server`
 sys.modules.setdefault('controller.server', sys.modules[__name__])
@@ -30,11 +35,175 @@ edit_tool = EditTool()
 mcp.add_tool(bash_tool)
 mcp.add_tool(edit_tool)
 
+WORKSPACE_DIR = "/workspace/vllm"
+# Environment for every git invocation: no prompts, no optional index locks, no system
+# config, and no auto-gc or fsmonitor work piggybacking on commands. Global config is still
+# read and no identity is exported, so a configured user.name/user.email always applies.
+GIT_ENV = {
+    **os.environ,
+    "GIT_TERMINAL_PROMPT": "0",
+    "GIT_OPTIONAL_LOCKS": "0",
+    "GIT_CONFIG_NOSYSTEM": "1",
+    "GIT_CONFIG_COUNT": "2",
+    "GIT_CONFIG_KEY_0": "gc.auto",
+    "GIT_CONFIG_VALUE_0": "0",
+    "GIT_CONFIG_KEY_1": "core.fsmonitor",
+    "GIT_CONFIG_VALUE_1": "false",
+}
+# Shared bytecode cache so test runs reuse .pyc files compiled by earlier runs
+PYCACHE_PREFIX = "/tmp/pycache"
+
+# Absolute path so subprocess can use posix_spawn, which requires a directory component
+GIT_EXECUTABLE = shutil.which("git") or "git"
+
+
+def run_git(args: List[str], cwd: str = WORKSPACE_DIR, **kwargs) -> subprocess.CompletedProcess:
+    """
+    Run git with GIT_ENV in `cwd`, launched via posix_spawn rather than fork+exec.
+
+    CPython only takes the posix_spawn path with close_fds=False and no cwd=, so the
+    directory is passed with `git -C` instead.
+    """
+    return subprocess.run(
+        [GIT_EXECUTABLE, "-C", cwd, *args],
+        env=GIT_ENV,
+        close_fds=False,
+        **kwargs
+    )
+
+
+# Single persistent `git cat-file --batch-check` process for cheap ref lookups, shared by
+# all tool threads; the lock serializes each request/response exchange
+_git_helper: Optional[subprocess.Popen] = None
+_git_helper_dir_id: Optional[int] = None
+_git_helper_lock = threading.Lock()
+
+
+def _stop_git_helper() -> None:
+    """Terminate the cat-file helper, if running. Caller must hold _git_helper_lock or be exiting."""
+    global _git_helper
+    if _git_helper is not None and _git_helper.poll() is None:
+        _git_helper.kill()
+        _git_helper.wait()
+    _git_helper = None
+
+
+atexit.register(_stop_git_helper)
+
+
+def _git_helper_proc() -> subprocess.Popen:
+    """Return the cat-file helper, respawning it if it died or .git was recreated."""
+    global _git_helper, _git_helper_dir_id
+    git_dir_id = os.stat(os.path.join(WORKSPACE_DIR, ".git")).st_ino
+    if _git_helper is not None and _git_helper.poll() is None and _git_helper_dir_id == git_dir_id:
+        return _git_helper
+    _stop_git_helper()
+    _git_helper = subprocess.Popen(
+        [GIT_EXECUTABLE, "-C", WORKSPACE_DIR, "cat-file", "--batch-check"],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        env=GIT_ENV,
+        close_fds=False,
+        text=True,
+        bufsize=1
+    )
+    _git_helper_dir_id = git_dir_id
+    return _git_helper
+
+
+def git_query(ref: str) -> Optional[str]:
+    """Resolve a ref via the persistent git helper. Returns the object id, or None if it does not exist."""
+    if not ref or any(c.isspace() for c in ref):
+        return None
+    try:
+        with _git_helper_lock:
+            proc = _git_helper_proc()
+            proc.stdin.write(ref + "\n")
+            proc.stdin.flush()
+            line = proc.stdout.readline()
+    except (OSError, ValueError) as e:
+        logging.warning(f"git helper query for '{ref}' failed: {e}")
+        return None
+    # "<oid> <type> <size>" on success, "<ref> missing" / "<ref> ambiguous" otherwise
+    parts = line.split()
+    if len(parts) != 3:
+        return None
+    return parts[0]
+
+
+def _pytest_env() -> Dict[str, str]:
+    """Environment for Python test subprocesses that keeps compiled bytecode between runs."""
+    env = {**os.environ, "PYTHONPYCACHEPREFIX": PYCACHE_PREFIX}
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    return env
+
+
+def run_pytest(args: List[str], cwd: str, timeout: float, max_output: int = 8192) -> Tuple[int, str]:
+    """
+    Run `python -m pytest` with `args` in `cwd` using the server's interpreter and the
+    shared bytecode cache, so modules compiled by earlier runs are not recompiled.
+
+    Output is streamed to a temp file and only its last `max_output` bytes are read back.
+
+    Returns:
+        Tuple of pytest exit code and the tail of the combined output
+
+    Raises:
+        subprocess.TimeoutExpired: If pytest does not finish within `timeout` seconds
+    """
+    with tempfile.NamedTemporaryFile(mode="w+b", prefix="pytest-", suffix=".log") as output:
+        # Own session so a timeout also kills any processes the tests started
+        proc = subprocess.Popen(
+            [sys.executable, "-m", "pytest", *args],
+            cwd=cwd,
+            env=_pytest_env(),
+            stdout=output,
+            stderr=subprocess.STDOUT,
+            start_new_session=True
+        )
+        try:
+            returncode = proc.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                # pytest and its children exited between the timeout and the kill
+                pass
+            proc.wait()
+            raise
+        output.seek(max(0, os.fstat(output.fileno()).st_size - max_output))
+        return returncode, output.read().decode("utf-8", errors="replace")
+
+
+def prewarm_test_imports() -> None:
+    """Import vllm and pytest in a background process to populate the bytecode and disk caches."""
+    try:
+        # Same interpreter as the test runs so both share one bytecode cache
+        proc = subprocess.Popen(
+            [sys.executable, "-c", "import vllm, pytest"],
+            cwd=WORKSPACE_DIR,
+            env=_pytest_env(),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+        # Reap the process when it finishes so it does not linger as a zombie
+        threading.Thread(target=proc.wait, name="prewarm-reaper", daemon=True).start()
+        logging.info("Started background prewarm of test imports")
+    except OSError as e:
+        logging.warning(f"Failed to prewarm test imports: {e}")
+
+
+def _load_cve_module(module_name: str) -> None:
+    try:
+        importlib.import_module(module_name)
+        logging.info(f"Successfully loaded CVE tools module: {module_name}")
+    except Exception as exc:
+        logging.exception(f"Failed to load CVE tools module '{module_name}': {exc}")
+
+
 def load_cve_tools() -> None:
     """Dynamically import all modules in controller.cves so their @mcp.tool functions register."""
-    import importlib
-    import pkgutil
-    
     logging.info("Starting CVE tools loading...")
     
     # Add src directory to path to allow controller.cves import
@@ -53,18 +222,20 @@ def load_cve_tools() -> None:
         logging.info("'controller.cves' is not a package; skipping dynamic tool loading.")
         return
     
-    modules_found = list(pkgutil.iter_modules(cves_pkg.__path__, cves_pkg.__name__ + "."))
-    logging.info(f"Found {len(modules_found)} CVE modules: {[m.name for m in modules_found]}")
+    # A single directory listing instead of pkgutil's per-entry import probing
+    modules_found = sorted(
+        f"{cves_pkg.__name__}.{entry.name[:-3]}"
+        for entry in os.scandir(cves_pkg.__path__[0])
+        if entry.is_file() and entry.name.endswith(".py") and not entry.name.startswith("_")
+    )
+    logging.info(f"Found {len(modules_found)} CVE modules: {modules_found}")
     
-    for module_info in modules_found:
-        module_name = module_info.name
-        try:
-            importlib.import_module(module_name)
-            logging.info(f"Successfully loaded CVE tools module: {module_name}")
-        except Exception as exc:
-            logging.exception(f"Failed to load CVE tools module '{module_name}': {exc}")
+    # Import on the main thread in sorted order so tools always register in the same order
+    for module_name in modules_found:
+        _load_cve_module(module_name)
     
     logging.info("CVE tools loading completed.")
+    prewarm_test_imports()
 
 
 if __name__ == "__main__":